@@ -0,0 +1,39 @@
+// Lock-free helpers for counters kept in multiprocessing shared memory.
+// Build with ./build_atomics.sh (loaded by atomics.py through ctypes).
+#include <stdint.h>
+
+
+uint64_t add_fetch_u64(uint64_t *ptr, uint64_t value) {
+    return __atomic_add_fetch(ptr, value, __ATOMIC_RELAXED);
+}
+
+
+// Counters packing an epoch (upper 32 bits) with a count (lower 32 bits), laid out as rows of
+// `row_size` counters. Counts one hit in `column` of `row` for `epoch` - a counter left over from
+// an older epoch starts from scratch - and returns the sum of `column` over all rows for `epoch`.
+uint64_t increase_epoch_counter(uint64_t *counters, uint64_t rows_num, uint64_t row_size,
+                                uint64_t row, uint64_t column, uint64_t epoch) {
+    uint64_t *counter = counters + row * row_size + column;
+    uint64_t value = __atomic_load_n(counter, __ATOMIC_RELAXED);
+    uint64_t new_value;
+
+    do {
+        new_value = (value >> 32 == epoch) ? value + 1 : (epoch << 32) | 1;
+    } while (!__atomic_compare_exchange_n(counter, &value, new_value, 1, __ATOMIC_ACQ_REL, __ATOMIC_RELAXED));
+
+    uint64_t total = 0;
+
+    for (uint64_t i = 0; i < rows_num; i++) {
+        value = __atomic_load_n(counters + i * row_size + column, __ATOMIC_RELAXED);
+        if (value >> 32 == epoch) {
+            total += value & 0xFFFFFFFF;
+        }
+    }
+
+    return total;
+}
+
+
+int compare_exchange_u8(uint8_t *ptr, uint8_t expected, uint8_t desired) {
+    return __atomic_compare_exchange_n(ptr, &expected, desired, 0, __ATOMIC_ACQ_REL, __ATOMIC_RELAXED);
+}
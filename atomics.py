@@ -0,0 +1,25 @@
+# ctypes bindings for atomics.c - operate on addresses inside multiprocessing.RawArray / RawValue
+import ctypes
+import os
+
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libatomics.so')
+
+_lib = ctypes.CDLL(LIBRARY_PATH)
+
+add_fetch_u64 = _lib.add_fetch_u64
+add_fetch_u64.argtypes = (ctypes.c_void_p, ctypes.c_uint64)
+add_fetch_u64.restype = ctypes.c_uint64
+
+increase_epoch_counter = _lib.increase_epoch_counter
+increase_epoch_counter.argtypes = (ctypes.c_void_p, ctypes.c_uint64, ctypes.c_uint64,
+                                   ctypes.c_uint64, ctypes.c_uint64, ctypes.c_uint64)
+increase_epoch_counter.restype = ctypes.c_uint64
+
+compare_exchange_u8 = _lib.compare_exchange_u8
+compare_exchange_u8.argtypes = (ctypes.c_void_p, ctypes.c_uint8, ctypes.c_uint8)
+compare_exchange_u8.restype = ctypes.c_bool
+
+
+def address_of(array, index):
+    """Address of `array[index]` usable by the functions above"""
+    return ctypes.addressof(array) + index * ctypes.sizeof(array._type_)
@@ -0,0 +1,7 @@
+#!/usr/bin/env bash
+
+
+echo "Build libatomics.so..."
+gcc -O2 -shared -fPIC -o libatomics.so atomics.c
+
+echo "Done!"
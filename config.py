@@ -0,0 +1,61 @@
+# Configuration from environment variables, falling back to .env file
+from collections import namedtuple
+from functools import lru_cache
+import os
+import pickle
+
+ENV_PATH = '.env'
+ENV_CACHE_PATH = '.env.pickle'
+
+
+class Config(namedtuple('Config', 'MIN_REQUESTS_COUNT SERVER_HOST SERVER_PORT SERVER_WORKER_NUM '
+                                  'SMTP_USER SMTP_PASS SMTP_SERVER SMTP_PORT EMAIL_RECEIVER')):
+
+    @classmethod
+    def from_env(cls, env):
+        smtp_user, smtp_pass, smtp_server, smtp_port = env['EMAIL_CREDS'].split(':')
+
+        return cls(
+            MIN_REQUESTS_COUNT=int(env['MIN_REQUESTS_COUNT']),
+            SERVER_HOST=env['SERVER_HOST'],
+            SERVER_PORT=env['SERVER_PORT'],
+            SERVER_WORKER_NUM=int(env['SERVER_WORKER_NUM']),
+            SMTP_USER=smtp_user,
+            SMTP_PASS=smtp_pass,
+            SMTP_SERVER=smtp_server,
+            SMTP_PORT=int(smtp_port),
+            EMAIL_RECEIVER=tuple(e for e in env['EMAIL_RECEIVER'].split(';') if e),
+        )
+
+
+def read_env_file(path=ENV_PATH, cache_path=ENV_CACHE_PATH):
+    """Parsed values of .env file, pickled next to it until the file changes"""
+    try:
+        if os.stat(cache_path).st_mtime > os.stat(path).st_mtime:
+            with open(cache_path, 'rb') as cache_file:
+                return pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    import dotenv
+    values = dotenv.dotenv_values(path)
+
+    # Write aside and rename, so other processes never load half-written cache
+    tmp_cache_path = f'{cache_path}.{os.getpid()}'
+    try:
+        with open(tmp_cache_path, 'wb') as cache_file:
+            pickle.dump(values, cache_file)
+        os.replace(tmp_cache_path, cache_path)
+    except OSError:
+        pass
+
+    return values
+
+
+@lru_cache(maxsize=None)
+def load_config():
+    try:
+        return Config.from_env(os.environ)
+    except KeyError:
+        # Values from .env file take precedence, like dotenv.load_dotenv(override=True)
+        return Config.from_env({**os.environ, **read_env_file()})
@@ -5,54 +5,148 @@
 
 # Copyright (c) 2018, Reef Technologies, BSD 3-Clause License
 
-from collections import namedtuple
-from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from functools import lru_cache
 import argparse
+import base64
 import os
 import smtplib
 import sys
+import threading
+import time
 
 
-class GmailSender(namedtuple('SmtpAuthData', 'server port user password')):
+# Multiple of 57 bytes, which base64 encodes into full 76 character lines
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
 
-    def send(self, addr_from, addr_to, subject, message, files=tuple()):
-        msg = MIMEMultipart('alternative')
-        msg['To'] = addr_to if isinstance(addr_to, str) else ';'.join(addr_to)
-        msg['From'] = addr_from
-        msg['Subject'] = subject
-
-        text = "view the html version."
-        msg.attach(MIMEText(text, 'plain'))
-        msg.attach(MIMEText(message, 'html'))
-
-        for file in files:
-            part = MIMEBase('application', "octet-stream")
-            with open(file, 'rb') as stream:
-                part.set_payload(stream.read())
-            encoders.encode_base64(part)
-            part.add_header(
-                'Content-Disposition',
-                'attachment; filename="%s"' % os.path.basename(file),
-            )
-            msg.attach(part)
+
+def encode_base64_stream(stream):
+    """Same output as email.encoders.encode_base64, without holding raw and encoded file at once"""
+    encoded = bytearray()
+
+    while True:
+        chunk = stream.read(ATTACHMENT_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        encoded += base64.encodebytes(chunk)
+
+    return encoded.decode('ascii')
+
+
+@lru_cache(maxsize=8)
+def encode_attachment(file, mtime):
+    """Base64 payload of attachment - modification time is part of the cache key, so changed file is read again"""
+    with open(file, 'rb') as stream:
+        return encode_base64_stream(stream)
+
+
+def build_message(addr_from, addr_to, subject, message, files):
+    msg = MIMEMultipart('alternative')
+    msg['To'] = addr_to if isinstance(addr_to, str) else ';'.join(addr_to)
+    msg['From'] = addr_from
+    msg['Subject'] = subject
+
+    text = "view the html version."
+    msg.attach(MIMEText(text, 'plain'))
+    msg.attach(MIMEText(message, 'html'))
+
+    for file in files:
+        part = MIMEBase('application', "octet-stream")
+        part.set_payload(encode_attachment(file, os.stat(file).st_mtime))
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header(
+            'Content-Disposition',
+            'attachment; filename="%s"' % os.path.basename(file),
+        )
+        msg.attach(part)
+
+    return msg.as_string()
+
+
+class GmailSender:
+    # Idle connection is checked with NOOP before it's reused
+    KEEPALIVE_INTERVAL = 60
+    # Long-lived connection may be dropped silently (e.g. by NAT) - don't block on it forever
+    SMTP_TIMEOUT = 30
+
+    def __init__(self, server, port, user, password):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+
+        self._conn = None
+        self._last_use = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._disconnect()
 
         # SSL
         if self.port == 465:
-            s = smtplib.SMTP_SSL(self.server, self.port)
+            s = smtplib.SMTP_SSL(self.server, self.port, timeout=self.SMTP_TIMEOUT)
             s.ehlo()
-        
+
         # TLS
         else:
-            s = smtplib.SMTP(self.server, self.port)
+            s = smtplib.SMTP(self.server, self.port, timeout=self.SMTP_TIMEOUT)
             s.ehlo()
             s.starttls()
 
         s.login(self.user, self.password)
-        s.sendmail(addr_from, addr_to, msg.as_string())
-        s.quit()
+        self._conn = s
+
+    def _disconnect(self):
+        if self._conn is None:
+            return
+
+        try:
+            self._conn.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+        self._conn = None
+
+    def _get_connection(self):
+        if self._conn is None:
+            self._connect()
+
+        elif time.monotonic() - self._last_use > self.KEEPALIVE_INTERVAL:
+            try:
+                code, _ = self._conn.noop()
+            except (smtplib.SMTPException, OSError):
+                code = None
+
+            if code != 250:
+                self._connect()
+
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def send(self, addr_from, addr_to, subject, message, files=tuple()):
+        msg_string = build_message(addr_from, addr_to, subject, message, files)
+
+        with self._lock:
+            try:
+                self._get_connection().sendmail(addr_from, addr_to, msg_string)
+
+            # Connection broke in the meantime (includes SSL errors of dropped TLS connection)
+            except OSError:
+                try:
+                    self._connect()
+                    self._conn.sendmail(addr_from, addr_to, msg_string)
+                except:
+                    # Never reuse connection which failed twice
+                    self._disconnect()
+                    raise
+
+            self._last_use = time.monotonic()
 
 
 def parse_arguments():
@@ -101,17 +195,11 @@ if __name__ == '__main__':
     addr_from = smtp_user
 
     print("Enter/Paste the message for email. Ctrl-%s to save it." % (os.name == 'nt' and 'Z' or 'D'))
-    message_lines = []
-    while True:
-        try:
-            line = input()
-        except EOFError:
-            break
-        message_lines.append(line)
+    message = sys.stdin.read()
 
     subject = parser_result.subject
-    message = '\n'.join(message_lines)
 
     sender = GmailSender(smtp_server, smtp_port, smtp_user, smtp_pass)
     print("Sending email...")
     sender.send(addr_from, addr_to, subject, message, files=files)
+    sender.close()
@@ -1,44 +1,41 @@
 # Based on https://tools.ietf.org/html/rfc7168
-import os
 import time
+import ctypes
 import multiprocessing
+import queue
+import threading
 import traceback
 
 from japronto import Application
 import click
 
+from config import load_config
+import atomics
 import emailhelper
 
 __version__ = '19.8.10'  # Year / Month / Day
 
 
 # Configuration (load .env file if variables aren't present)
-for _ in range(2):
-    try:
-        MIN_REQUESTS_COUNT = int(os.environ['MIN_REQUESTS_COUNT'])
-        SERVER_HOST = os.environ['SERVER_HOST']
-        SERVER_PORT = os.environ['SERVER_PORT']
-        SERVER_WORKER_NUM = int(os.environ['SERVER_WORKER_NUM'])
-        SMTP_USER, SMTP_PASS, SMTP_SERVER, SMTP_PORT = os.environ['EMAIL_CREDS'].split(':')
-        SMTP_PORT = int(SMTP_PORT)
-        EMAIL_RECEIVER = [e for e in os.environ['EMAIL_RECEIVER'].split(';') if e]
-    except KeyError:
-        import dotenv
-        dotenv.load_dotenv('.env', override=True)
-    else:
-        break
+CFG = load_config()
 
 
 TEA_CONTENT_TYPE = 'message/teapot'
-TEA_VARIANTS = [
+TEA_VARIANTS = (
     'english-breakfast',
     'earl-grey',
-]
+)
 HIGH_TRAFFIC_VARIANT = 'earl-grey'
 
-with open('home.html') as home_html_file:
+ENDPOINT_ID = {variant: variant_id for variant_id, variant in enumerate(TEA_VARIANTS)}
+UNKNOWN_ENDPOINT_ID = 0xFF
+
+with open('home.html', 'rb') as home_html_file:
     HOME_HTML_CONTENT = home_html_file.read()
 
+# japronto adds Content-Length on its own
+HOME_HEADERS = {'Content-Type': 'text/html'}
+
 
 def create_alternates():
     return ', '.join(
@@ -48,207 +45,272 @@ def create_alternates():
 
 
 TEA_ALTERNATES = create_alternates()
+ALTERNATES_HEADERS = {'Alternates': TEA_ALTERNATES}
+
+email_client = emailhelper.GmailSender(CFG.SMTP_SERVER, CFG.SMTP_PORT, CFG.SMTP_USER, CFG.SMTP_PASS)
+
+EMAIL_QUEUE_SIZE = 1000
+email_queue = None  # Created by each worker process on first use - threads don't survive fork
 
-email_client = emailhelper.GmailSender(SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASS)
+# Runtime variables (allocated in shared memory before japronto forks its workers)
+POTS_SLOTS_NUM = 2 ** 20
+TRAFFIC_SLOTS_NUM = 2 ** 14
 
-# Runtime variables
-mp_manager = multiprocessing.Manager()
+POTS_BREWING = multiprocessing.RawArray(ctypes.c_uint8, POTS_SLOTS_NUM)
 
-POTS_BREWING = mp_manager.dict()
+WORKER_ID_COUNTER = multiprocessing.RawValue(ctypes.c_uint64)
+WORKER_ID = None  # Assigned by each worker process on first use
 
-TRAFFIC = mp_manager.dict()
-TRAFFIC_LOCK_INCREASE = mp_manager.Lock()
-TRAFFIC_LOCK_ADD_SECOND = mp_manager.Lock()
-TRAFFIC_LOCK_DEL_SECOND = mp_manager.Lock()
 
+def allocate_traffic(rows_num):
+    """
+    One row of slots per worker, so workers don't fight over the same cache lines.
+    Every slot packs the second it counts (upper 32 bits) with its request count (lower 32 bits)
+    """
+    global TRAFFIC, TRAFFIC_ADDRESS, TRAFFIC_ROWS_NUM
 
-def get_request_key(request):
-    endpoint = request.match_dict.get('endpoint', '')
-    return f'{request.remote_addr}/{endpoint}'
+    TRAFFIC = multiprocessing.RawArray(ctypes.c_uint64, rows_num * TRAFFIC_SLOTS_NUM)
+    TRAFFIC_ADDRESS = ctypes.addressof(TRAFFIC)
+    TRAFFIC_ROWS_NUM = rows_num
 
 
-def set_brewing_state(request, brewing_state):
-    POTS_BREWING[get_request_key(request)] = brewing_state
+# Reallocated by cli() for the actual number of workers
+allocate_traffic(CFG.SERVER_WORKER_NUM)
 
 
-def get_brewing_state(request):
-    return POTS_BREWING.get(get_request_key(request), False)
+def get_request_key(remote_addr, endpoint):
+    # hash() is randomized per interpreter, but forked workers share the seed of the parent process
+    return hash(remote_addr) ^ ENDPOINT_ID.get(endpoint, UNKNOWN_ENDPOINT_ID)
 
 
-def increase_or_set(lock, dict_obj, key, default):
-    lock.acquire()
+def start_brewing(request_key):
+    """Returns False if the pot was already brewing"""
+    slot = request_key % POTS_SLOTS_NUM
+    return atomics.compare_exchange_u8(atomics.address_of(POTS_BREWING, slot), False, True)
 
-    if key in dict_obj:
-        value = dict_obj[key]
-        value += 1
-    else:
-        value = default
 
-    dict_obj[key] = value
-    lock.release()
-    return value
+def stop_brewing(request_key):
+    """Returns False if the pot wasn't brewing"""
+    slot = request_key % POTS_SLOTS_NUM
+    return atomics.compare_exchange_u8(atomics.address_of(POTS_BREWING, slot), True, False)
 
 
-def increase_traffic_by_request(request):
-    cur_second_int = int(time.time())
-    request_key = get_request_key(request)
+def get_brewing_state(request_key):
+    return bool(POTS_BREWING[request_key % POTS_SLOTS_NUM])
+
+
+def get_worker_id():
+    global WORKER_ID
 
-    # Clear old seconds (only if it's not already being cleared)
-    if TRAFFIC_LOCK_DEL_SECOND.acquire():
-        for second in TRAFFIC.keys():
-            if second < cur_second_int:
-                del TRAFFIC[second]
+    if WORKER_ID is None:
+        # Workers beyond TRAFFIC_ROWS_NUM share rows - still correct, as slots are updated atomically
+        worker_num = atomics.add_fetch_u64(ctypes.addressof(WORKER_ID_COUNTER), 1) - 1
+        WORKER_ID = worker_num % TRAFFIC_ROWS_NUM
 
-        TRAFFIC_LOCK_DEL_SECOND.release()
+    return WORKER_ID
 
-    TRAFFIC_LOCK_ADD_SECOND.acquire()
-    # First time handling current second
-    if cur_second_int not in TRAFFIC:
-        cur_second_counter = mp_manager.dict()
-        TRAFFIC[cur_second_int] = cur_second_counter
-    # Another time handling current second
-    else:
-        cur_second_counter = TRAFFIC[cur_second_int]
 
-    TRAFFIC_LOCK_ADD_SECOND.release()
+def increase_traffic_by_request(request_key):
+    cur_second_int = int(time.time())
+    slot = request_key % TRAFFIC_SLOTS_NUM
 
-    request_traffic = increase_or_set(TRAFFIC_LOCK_INCREASE, cur_second_counter, request_key, 1)
+    request_traffic = atomics.increase_epoch_counter(
+        TRAFFIC_ADDRESS, TRAFFIC_ROWS_NUM, TRAFFIC_SLOTS_NUM, get_worker_id(), slot, cur_second_int
+    )
 
-    # print(f'Increasing {request_key!r} from value {request_traffic} (second {cur_second_int})')
+    # print(f'Increasing slot {slot} to total {request_traffic} (second {cur_second_int})')
 
     return request_traffic
 
 
-def slash(request):
-    """
-    :type request:
-    """
+def send_emails_from_queue(jobs):
+    while True:
+        job = jobs.get()
+
+        try:
+            email_client.send(**job)
+        except:
+            print(traceback.format_exc())
+
+
+def send_email_in_background(**job):
+    global email_queue
+
+    if email_queue is None:
+        email_queue = queue.Queue(EMAIL_QUEUE_SIZE)
+        threading.Thread(target=send_emails_from_queue, args=(email_queue,), daemon=True).start()
+
+    try:
+        email_queue.put_nowait(job)
+    except queue.Full:
+        print(f'Email queue is full, dropping email {job["subject"]!r}')
+
+
+def brew_no_pot(request, endpoint):
+    return request.Response(
+        code=300,
+        headers=ALTERNATES_HEADERS
+    )
 
-    endpoint = request.match_dict.get('endpoint', '')
 
-    if request.method == 'GET':
+def brew_unknown_pot(request, endpoint):
+    return request.Response(
+        code=503,
+        text=f'"{endpoint}" is not supported for this pot'
+    )
+
+
+def start_brew(request, endpoint, request_key):
+    # Pot is busy - already brewing
+    if get_brewing_state(request_key):
         return request.Response(
-            code=200,
-            text=HOME_HTML_CONTENT,
-            headers={'Content-Type': 'text/html'}
+            code=503,
+            text='Pot is busy'
         )
 
-    if request.method == 'BREW':
+    # Make sure there is enough traffic for high traffic pot
+    if endpoint == HIGH_TRAFFIC_VARIANT:
+        traffic = increase_traffic_by_request(request_key)
 
-        if endpoint == '':
+        # Traffic is summed over workers' rows after counting, so concurrent requests handled by
+        # different workers may report the same total - only the latest total is guaranteed complete
+        if traffic < CFG.MIN_REQUESTS_COUNT:
+            # FIXME: uvloop is unable to return status code 424
+            #        see https://github.com/squeaky-pl/japronto/issues/131
             return request.Response(
-                code=300,
-                headers={'Alternates': TEA_ALTERNATES}
+                code=424,
+                text=f'Traffic too low to brew "{endpoint}" tea: {traffic}/{CFG.MIN_REQUESTS_COUNT}'
             )
 
-        # Some pot
-        elif endpoint in TEA_VARIANTS:
-
-            # Wrong Content-Type
-            if request.headers.get('Content-Type', '') != TEA_CONTENT_TYPE:
-                return request.Response(
-                    code=400,
-                    headers={'Alternates': TEA_ALTERNATES}
-                )
-
-            is_brewing = get_brewing_state(request)
-
-            # Start brewing
-            if request.body == b'start':
-
-                # Pot is busy - already brewing
-                if is_brewing:
-                    return request.Response(
-                        code=503,
-                        text='Pot is busy'
-                    )
-
-                # Make sure there is enough traffic for high traffic pot
-                if endpoint == HIGH_TRAFFIC_VARIANT:
-                    traffic = increase_traffic_by_request(request)
-
-                    if traffic < MIN_REQUESTS_COUNT:
-                        # FIXME: uvloop is unable to return status code 424
-                        #        see https://github.com/squeaky-pl/japronto/issues/131
-                        return request.Response(
-                            code=424,
-                            text=f'Traffic too low to brew "{endpoint}" tea: {traffic}/{MIN_REQUESTS_COUNT}'
-                        )
-
-                # Successfully start brewing
-                set_brewing_state(request, True)
-
-                return request.Response(
-                    code=202,
-                    text='Brewing'
-                )
-
-            # Stop brewing
-            if request.body == b'stop':
-
-                if not is_brewing:
-                    return request.Response(
-                        code=400,
-                        text='No beverage is being brewed by this pot',
-                    )
-
-                client_email = request.headers.get('Email', '')
-
-                if not client_email:
-                    return request.Response(
-                        code=400,
-                        text='Please set "Email" header in your request to your email address'
-                    )
-
-                try:
-                    email_client.send(
-                        addr_from=SMTP_USER,
-                        addr_to=EMAIL_RECEIVER,
-                        subject=f'Someone has completed recruitment task v{__version__} - {client_email}',
-                        message=f'Candidate has successfully brewed tea {endpoint!r} from IP {request.remote_addr}, '
-                                f'using mail {client_email!r} and host {request.headers.get("Host", "Unknown")!r}.'
-                    )
-                except:
-                    print(traceback.format_exc())
-                    return request.Response(
-                        code=500,
-                        text='Something went wrong'
-                    )
-
-                # Successfully stop brewing
-                set_brewing_state(request, False)
-
-                return request.Response(
-                    code=201,
-                    text='Finished',
-                )
+    # Another request has started brewing in the meantime
+    if not start_brewing(request_key):
+        return request.Response(
+            code=503,
+            text='Pot is busy'
+        )
+
+    # Successfully start brewing
+    return request.Response(
+        code=202,
+        text='Brewing'
+    )
 
-            return request.Response(
-                code=400
-            )
 
-        # Unknown pot
-        else:
-            return request.Response(
-                code=503,
-                text=f'"{endpoint}" is not supported for this pot'
-            )
+def stop_brew(request, endpoint, request_key):
+    if not get_brewing_state(request_key):
+        return request.Response(
+            code=400,
+            text='No beverage is being brewed by this pot',
+        )
+
+    client_email = request.headers.get('Email', '')
+
+    if not client_email:
+        return request.Response(
+            code=400,
+            text='Please set "Email" header in your request to your email address'
+        )
+
+    # Another request has stopped brewing in the meantime
+    if not stop_brewing(request_key):
+        return request.Response(
+            code=400,
+            text='No beverage is being brewed by this pot',
+        )
+
+    # Email is only a notification - don't keep the client waiting for SMTP
+    send_email_in_background(
+        addr_from=CFG.SMTP_USER,
+        addr_to=CFG.EMAIL_RECEIVER,
+        subject=f'Someone has completed recruitment task v{__version__} - {client_email}',
+        message=f'Candidate has successfully brewed tea {endpoint!r} from IP {request.remote_addr}, '
+                f'using mail {client_email!r} and host {request.headers.get("Host", "Unknown")!r}.'
+    )
+
+    # Successfully stop brewing
+    return request.Response(
+        code=201,
+        text='Finished',
+    )
+
+
+def brew_pot(request, endpoint):
+    # Wrong Content-Type
+    if request.headers.get('Content-Type', '') != TEA_CONTENT_TYPE:
+        return request.Response(
+            code=400,
+            headers=ALTERNATES_HEADERS
+        )
+
+    body = request.body
+
+    if body == b'start':
+        return start_brew(request, endpoint, get_request_key(request.remote_addr, endpoint))
+
+    if body == b'stop':
+        return stop_brew(request, endpoint, get_request_key(request.remote_addr, endpoint))
+
+    return request.Response(
+        code=400
+    )
+
+
+def home(request):
+    return request.Response(
+        code=200,
+        body=HOME_HTML_CONTENT,
+        headers=HOME_HEADERS
+    )
+
+
+def create_route_handler(brew_handler, endpoint):
+    def route_handler(request):
+        method = request.method
+
+        if method == 'GET':
+            return home(request)
+
+        if method == 'BREW':
+            return brew_handler(request, endpoint)
 
-    else:
         return request.Response(code=405)
 
+    return route_handler
+
+
+def slash(request):
+    """
+    Any endpoint without its own route
+    :type request:
+    """
+
+    method = request.method
+
+    if method == 'GET':
+        return home(request)
+
+    if method == 'BREW':
+        return brew_unknown_pot(request, request.match_dict['endpoint'])
+
+    return request.Response(code=405)
+
 
 app = Application()
 r = app.router
 
-r.add_route('/', slash)
+# Routes are matched in order of adding - pots go before the catch-all route
+r.add_route('/', create_route_handler(brew_no_pot, ''))
+
+for variant in TEA_VARIANTS:
+    r.add_route(f'/{variant}', create_route_handler(brew_pot, variant))
+
 r.add_route('/{endpoint}', slash)
 
 
 @click.command()
-@click.option('--host', default=SERVER_HOST)
-@click.option('--port', default=SERVER_PORT)
-@click.option('--worker-num', default=SERVER_WORKER_NUM)
+@click.option('--host', default=CFG.SERVER_HOST)
+@click.option('--port', default=CFG.SERVER_PORT)
+@click.option('--worker-num', default=CFG.SERVER_WORKER_NUM)
 @click.option('--debug', default=False, is_flag=True)
 def cli(host, port, worker_num, debug):
     click.echo('Starting server with following configuration:')
@@ -257,10 +319,15 @@ def cli(host, port, worker_num, debug):
     click.echo('Worker number: %r' % worker_num)
     click.echo('Debug: %r' % debug)
 
+    worker_num = int(worker_num) if worker_num else None
+
+    # Before japronto forks, so workers inherit it - japronto starts a single worker by default
+    allocate_traffic(worker_num or 1)
+
     app.run(
         host=host,
         port=int(port),
-        worker_num=int(worker_num) if worker_num else None,
+        worker_num=worker_num,
         debug=debug
     )
 
@@ -1,8 +1,13 @@
 import unittest
+import os
 import time
+import tempfile
 import threading
 import multiprocessing
 import asyncio
+import smtplib
+import ssl
+from unittest import mock
 
 import requests
 from aiohttp import ClientSession
@@ -13,6 +18,8 @@ import psutil
 dotenv.load_dotenv('.env.test', override=True)
 
 
+import config
+import emailhelper
 import server
 
 
@@ -21,23 +28,28 @@ def sleep_to_next_second():
     time.sleep(time_left_to_next_second)
 
 
-class FakeRequest:
-    def __init__(self, remote_addr, endpoint):
-        self.remote_addr = remote_addr
-        self.match_dict = {'endpoint': endpoint}
-
-
 class TestTrafficCounter(unittest.TestCase):
     def create_processes_to_increase_traffic(self, processes_count, request_ip, tea_variant, results_list):
         return [
             multiprocessing.Process(
                 target=lambda: results_list.append(
-                    server.increase_traffic_by_request(FakeRequest(request_ip, tea_variant))
+                    server.increase_traffic_by_request(server.get_request_key(request_ip, tea_variant))
                 )
             )
             for _ in range(processes_count)
         ]
 
+    def assert_traffic_totals(self, results, expected_traffic):
+        # Totals of concurrent increases may repeat - but the latest one covers all of them
+        self.assertEqual(
+            max(results),
+            expected_traffic
+        )
+        self.assertLessEqual(
+            set(results),
+            set(range(1, expected_traffic + 1))
+        )
+
     def run_processes_with_next_second(self, processes):
         sleep_to_next_second()
         [t.start() for t in processes]
@@ -54,14 +66,7 @@ class TestTrafficCounter(unittest.TestCase):
             len(results),
             processes_count
         )
-        self.assertEqual(
-            sorted(results),
-            list(range(1, processes_count + 1))
-        )
-        self.assertEqual(
-            len(server.TRAFFIC),
-            1
-        )
+        self.assert_traffic_totals(results, processes_count)
 
     def test_increase_by_single_client_many_variants(self):
         processes_count = 10
@@ -78,14 +83,7 @@ class TestTrafficCounter(unittest.TestCase):
             len(results),
             processes_count*2
         )
-        self.assertEqual(
-            set(results),
-            set(range(1, processes_count + 1))
-        )
-        self.assertEqual(
-            len(server.TRAFFIC),
-            1
-        )
+        self.assert_traffic_totals(results, processes_count)
 
     def test_increase_by_many_clients_single_variant(self):
         processes_count = 10
@@ -102,92 +100,328 @@ class TestTrafficCounter(unittest.TestCase):
             len(results),
             processes_count*2
         )
-        self.assertEqual(
-            set(results),
-            set(range(1, processes_count + 1))
-        )
-        self.assertEqual(
-            len(server.TRAFFIC),
-            1
-        )
-
-    def test_increase_deletes_old_seconds(self):
-        results = multiprocessing.Manager().list()
+        self.assert_traffic_totals(results, processes_count)
 
+    def test_increase_restarts_in_new_second(self):
         for _ in range(3):
-            time.sleep(1)
+            results = multiprocessing.Manager().list()
 
-            self.create_processes_to_increase_traffic(1, '127.0.0.1', 'earl-gray', results)
+            processes = self.create_processes_to_increase_traffic(1, '127.0.0.1', 'earl-gray', results)
+            self.run_processes_with_next_second(processes)
 
-            # Only 1 second in traffic recorded
+            # Traffic from previous second is not counted
             self.assertEqual(
-                len(server.TRAFFIC),
-                1
-            )
-
-            traffic_key = next(iter(server.TRAFFIC.keys()))
-
-            # Only 1 variant in given second
-            self.assertEqual(
-                len(server.TRAFFIC[traffic_key]),
-                1
+                list(results),
+                [1]
             )
 
 
 class TestPotsState(unittest.TestCase):
     def setUp(self):
-        self.earl_grey_request = FakeRequest('127.0.0.1', 'earl-grey')
-        self.earl_grey_another_request = FakeRequest('127.0.0.2', 'earl-grey')
-        self.english_breakfast_request = FakeRequest('127.0.0.1', 'english-breakfast')
+        self.earl_grey_key = server.get_request_key('127.0.0.1', 'earl-grey')
+        self.earl_grey_another_key = server.get_request_key('127.0.0.2', 'earl-grey')
+        self.english_breakfast_key = server.get_request_key('127.0.0.1', 'english-breakfast')
+
+    def tearDown(self):
+        for request_key in (self.earl_grey_key, self.earl_grey_another_key, self.english_breakfast_key):
+            server.stop_brewing(request_key)
 
     def test_initial_state(self):
         self.assertEqual(
-            server.get_brewing_state(self.earl_grey_request),
+            server.get_brewing_state(self.earl_grey_key),
             False
         )
         self.assertEqual(
-            server.get_brewing_state(self.earl_grey_another_request),
+            server.get_brewing_state(self.earl_grey_another_key),
             False
         )
         self.assertEqual(
-            server.get_brewing_state(self.english_breakfast_request),
+            server.get_brewing_state(self.english_breakfast_key),
             False
         )
 
     def test_start_brewing(self):
-        server.set_brewing_state(self.earl_grey_request, True)
+        server.start_brewing(self.earl_grey_key)
 
         self.assertEqual(
-            server.get_brewing_state(self.earl_grey_request),
+            server.get_brewing_state(self.earl_grey_key),
             True
         )
         self.assertEqual(
-            server.get_brewing_state(self.earl_grey_another_request),
+            server.get_brewing_state(self.earl_grey_another_key),
             False
         )
         self.assertEqual(
-            server.get_brewing_state(self.english_breakfast_request),
+            server.get_brewing_state(self.english_breakfast_key),
             False
         )
 
     def test_stop_brewing(self):
-        server.set_brewing_state(self.earl_grey_request, True)
-        server.set_brewing_state(self.earl_grey_request, False)
+        server.start_brewing(self.earl_grey_key)
+        server.stop_brewing(self.earl_grey_key)
+
+        self.assertEqual(
+            server.get_brewing_state(self.earl_grey_key),
+            False
+        )
+        self.assertEqual(
+            server.get_brewing_state(self.earl_grey_another_key),
+            False
+        )
+        self.assertEqual(
+            server.get_brewing_state(self.english_breakfast_key),
+            False
+        )
 
+    def test_start_brewing_only_once(self):
         self.assertEqual(
-            server.get_brewing_state(self.earl_grey_request),
+            server.start_brewing(self.earl_grey_key),
+            True
+        )
+        self.assertEqual(
+            server.start_brewing(self.earl_grey_key),
             False
         )
         self.assertEqual(
-            server.get_brewing_state(self.earl_grey_another_request),
+            server.start_brewing(self.english_breakfast_key),
+            True
+        )
+
+        server.stop_brewing(self.earl_grey_key)
+
+        self.assertEqual(
+            server.start_brewing(self.earl_grey_key),
+            True
+        )
+
+    def test_stop_brewing_only_once(self):
+        self.assertEqual(
+            server.stop_brewing(self.earl_grey_key),
             False
         )
+
+        server.start_brewing(self.earl_grey_key)
+
         self.assertEqual(
-            server.get_brewing_state(self.english_breakfast_request),
+            server.stop_brewing(self.earl_grey_key),
+            True
+        )
+        self.assertEqual(
+            server.stop_brewing(self.earl_grey_key),
             False
         )
 
 
+class TestConfig(unittest.TestCase):
+    def test_env_file_cached_until_changed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env_path = os.path.join(tmp_dir, '.env')
+            cache_path = os.path.join(tmp_dir, '.env.pickle')
+
+            with open(env_path, 'w') as env_file:
+                env_file.write('SERVER_PORT=1\n')
+
+            self.assertEqual(
+                config.read_env_file(env_path, cache_path),
+                {'SERVER_PORT': '1'}
+            )
+            self.assertTrue(
+                os.path.exists(cache_path)
+            )
+
+            with open(env_path, 'w') as env_file:
+                env_file.write('SERVER_PORT=2\n')
+
+            # Cache is newer than the file - parsed values are not read again
+            cache_mtime = os.stat(cache_path).st_mtime
+            os.utime(env_path, (cache_mtime - 1, cache_mtime - 1))
+
+            self.assertEqual(
+                config.read_env_file(env_path, cache_path),
+                {'SERVER_PORT': '1'}
+            )
+
+            # File changed after cache was written
+            os.utime(env_path, (cache_mtime + 1, cache_mtime + 1))
+
+            self.assertEqual(
+                config.read_env_file(env_path, cache_path),
+                {'SERVER_PORT': '2'}
+            )
+
+
+class FakeSmtp:
+    # Exceptions raised by upcoming sendmail() calls, in order
+    sendmail_errors = []
+    noop_code = 250
+
+    def __init__(self, server, port, timeout=None):
+        self.sent = []
+        self.noops = 0
+        self.quits = 0
+
+    def ehlo(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def noop(self):
+        self.noops += 1
+        return self.noop_code, b''
+
+    def quit(self):
+        self.quits += 1
+
+    def sendmail(self, addr_from, addr_to, msg):
+        if self.sendmail_errors:
+            raise self.sendmail_errors.pop(0)
+
+        self.sent.append(addr_to)
+
+
+class TestGmailSender(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+
+        def connect(*args, **kwargs):
+            connection = FakeSmtp(*args, **kwargs)
+            self.connections.append(connection)
+            return connection
+
+        FakeSmtp.sendmail_errors = []
+        FakeSmtp.noop_code = 250
+
+        patcher = mock.patch('smtplib.SMTP_SSL', side_effect=connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.sender = emailhelper.GmailSender('smtp.test', 465, 'user', 'password')
+
+    def send(self, addr_to='to@email.com'):
+        self.sender.send('from@email.com', addr_to, 'Subject', 'Message')
+
+    def test_connection_reused(self):
+        self.send('first@email.com')
+        self.send('second@email.com')
+
+        self.assertEqual(
+            len(self.connections),
+            1
+        )
+        self.assertEqual(
+            self.connections[0].sent,
+            ['first@email.com', 'second@email.com']
+        )
+        self.assertEqual(
+            self.connections[0].quits,
+            0
+        )
+
+    def test_reconnect_on_disconnect(self):
+        self.send()
+        FakeSmtp.sendmail_errors = [smtplib.SMTPServerDisconnected()]
+        self.send()
+
+        self.assertEqual(
+            len(self.connections),
+            2
+        )
+        self.assertEqual(
+            self.connections[1].sent,
+            ['to@email.com']
+        )
+
+    def test_reconnect_on_ssl_error(self):
+        self.send()
+        FakeSmtp.sendmail_errors = [ssl.SSLEOFError()]
+        self.send()
+
+        self.assertEqual(
+            len(self.connections),
+            2
+        )
+        self.assertEqual(
+            self.connections[1].sent,
+            ['to@email.com']
+        )
+
+    def test_failed_retry_not_reused(self):
+        FakeSmtp.sendmail_errors = [ssl.SSLEOFError(), ssl.SSLEOFError()]
+
+        with self.assertRaises(ssl.SSLEOFError):
+            self.send()
+
+        self.send()
+
+        self.assertEqual(
+            len(self.connections),
+            3
+        )
+        self.assertEqual(
+            self.connections[2].sent,
+            ['to@email.com']
+        )
+
+    def test_noop_after_idle(self):
+        now = 1000
+
+        with mock.patch('time.monotonic', side_effect=lambda: now):
+            self.send()
+
+            # Still fresh - no NOOP
+            now += self.sender.KEEPALIVE_INTERVAL
+            self.send()
+
+            self.assertEqual(
+                self.connections[0].noops,
+                0
+            )
+
+            # Idle connection answering NOOP is reused
+            now += self.sender.KEEPALIVE_INTERVAL + 1
+            self.send()
+
+            self.assertEqual(
+                self.connections[0].noops,
+                1
+            )
+            self.assertEqual(
+                len(self.connections),
+                1
+            )
+
+            # Idle connection not answering NOOP is replaced
+            now += self.sender.KEEPALIVE_INTERVAL + 1
+            FakeSmtp.noop_code = 421
+            self.send()
+
+        self.assertEqual(
+            len(self.connections),
+            2
+        )
+        self.assertEqual(
+            self.connections[1].sent,
+            ['to@email.com']
+        )
+
+    def test_close(self):
+        self.send()
+        self.sender.close()
+
+        self.assertEqual(
+            self.connections[0].quits,
+            1
+        )
+
+        self.send()
+
+        self.assertEqual(
+            len(self.connections),
+            2
+        )
+
+
 class TestServer(unittest.TestCase):
     SERVER_EXE_PATH = 'server.py'
     SERVER_TEST_PORT = 10000
@@ -199,12 +433,16 @@ class TestServer(unittest.TestCase):
 
         server.email_client.send = non_op_func
 
-        self.host = server.SERVER_HOST
+        self.host = server.CFG.SERVER_HOST
         self.port = self.SERVER_TEST_PORT
         self.__class__.SERVER_TEST_PORT += 1
 
         self.base_url = f'http://{self.host}:{self.port}'
 
+        # Keep-alive connections, enough for all concurrent requests of a test
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=server.CFG.MIN_REQUESTS_COUNT))
+
         args = [
             'python',
             'server.py',
@@ -232,6 +470,8 @@ class TestServer(unittest.TestCase):
                 break
 
     def tearDown(self):
+        self.session.close()
+
         server_processes = [self.server_process]
         server_processes.extend(self.server_process.children(recursive=True))
 
@@ -256,7 +496,7 @@ class TestServer(unittest.TestCase):
 
     def request(self, method, endpoint, **kwargs):
         url = f'{self.base_url}{endpoint}'
-        return requests.request(method.upper(), url, timeout=None, **kwargs)
+        return self.session.request(method.upper(), url, timeout=None, **kwargs)
 
     def test_invalid_method(self):
         bad_requests = [
@@ -422,7 +662,7 @@ class TestServer(unittest.TestCase):
                 headers={'Content-Type': 'message/teapot'}
             )
         )
-        threads = [threading.Thread(target=start_brew) for _ in range(server.MIN_REQUESTS_COUNT)]
+        threads = [threading.Thread(target=start_brew) for _ in range(server.CFG.MIN_REQUESTS_COUNT)]
         sleep_to_next_second()
         [t.start() for t in threads]
         [t.join() for t in threads]
@@ -451,7 +691,7 @@ class TestServer(unittest.TestCase):
                 headers={'Content-Type': 'message/teapot'}
             )
         )
-        threads = [threading.Thread(target=start_brew) for _ in range(server.MIN_REQUESTS_COUNT)]
+        threads = [threading.Thread(target=start_brew) for _ in range(server.CFG.MIN_REQUESTS_COUNT)]
         sleep_to_next_second()
         [t.start() for t in threads]
         [t.join() for t in threads]
@@ -482,19 +722,19 @@ class TestServer(unittest.TestCase):
                 headers={'Content-Type': 'message/teapot'}
             )
         )
-        threads = [threading.Thread(target=start_brew) for _ in range(server.MIN_REQUESTS_COUNT - 1)]
+        threads = [threading.Thread(target=start_brew) for _ in range(server.CFG.MIN_REQUESTS_COUNT - 1)]
         sleep_to_next_second()
         [t.start() for t in threads]
         [t.join() for t in threads]
 
         self.assertEqual(
             len(responses),
-            server.MIN_REQUESTS_COUNT - 1
+            server.CFG.MIN_REQUESTS_COUNT - 1
         )
 
         expected_messages = [
-            f'Traffic too low to brew "earl-grey" tea: {traffic}/{server.MIN_REQUESTS_COUNT}'
-            for traffic in range(1, server.MIN_REQUESTS_COUNT)
+            f'Traffic too low to brew "earl-grey" tea: {traffic}/{server.CFG.MIN_REQUESTS_COUNT}'
+            for traffic in range(1, server.CFG.MIN_REQUESTS_COUNT)
         ]
 
         for response in responses:
@@ -508,16 +748,14 @@ class TestServer(unittest.TestCase):
                 expected_messages
             )
 
-            expected_messages = list(filter(lambda msg: msg != response.text, expected_messages))
-
-        self.assertEqual(
-            expected_messages,
-            []
+        self.assertIn(
+            expected_messages[-1],
+            [response.text for response in responses]
         )
 
     def test_start_brew_earl_grey_stress_test(self):
         requests_count = 10000
-        server_workers = server.SERVER_WORKER_NUM
+        server_workers = server.CFG.SERVER_WORKER_NUM
         max_expected_duration = 10
 
         self.tearDown()
@@ -561,7 +799,7 @@ class TestServer(unittest.TestCase):
             headers={'Content-Type': 'message/teapot'}
         )
 
-        threads = [threading.Thread(target=start_brew) for _ in range(server.MIN_REQUESTS_COUNT)]
+        threads = [threading.Thread(target=start_brew) for _ in range(server.CFG.MIN_REQUESTS_COUNT)]
         sleep_to_next_second()
         [t.start() for t in threads]
         [t.join() for t in threads]